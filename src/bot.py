@@ -4,11 +4,14 @@ import logging
 import os
 import asyncio
 import datetime
+import time
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Update
 )
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (
     filters,
     Application,
@@ -19,8 +22,11 @@ from telegram.ext import (
     MessageHandler,
     AIORateLimiter,
 )
+from telegram.request import HTTPXRequest
 import chatgpt
 import db_handler
+import monitor
+import tracing
 
 
 logging.basicConfig(
@@ -29,6 +35,24 @@ logging.basicConfig(
 )
 
 db = None
+ADMIN_TG_IDS = [int(i) for i in os.environ.get("ADMIN_TG_IDS", "").split(",") if i]
+PROFILE_MAX_SEC = 300
+SEARCH_LABEL_LEN = 60
+# Turns still running after this are resumed from the journal on the next start
+DRAIN_TIMEOUT_SEC = 50
+resumed_turns = set()
+
+
+def handler(f):
+    return monitor.handler(tracing.handler(f))
+
+
+class TracedRequest(HTTPXRequest):
+    """Runs every Bot API call in a span named after the API method"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        with tracing.span(f"telegram.{url.rsplit('/', 1)[-1]}"):
+            return await super().do_request(url, method, *args, **kwargs)
 
 
 async def auth(update: Update):
@@ -85,7 +109,10 @@ async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
     def get_label(model):
         created = datetime.datetime.fromtimestamp(model["created"])
         created = created.strftime("%d %b %Y")
-        return f"{created} {model['model']}"
+        if model["context_window"] is None:
+            return f"{created} {model['model']}"
+        context = model["context_window"] // 1000
+        return f"{created} {model['model']} ({context}k)"
 
     try:
         user_id = await auth(update)
@@ -141,6 +168,35 @@ async def list_conversations(update: Update, context: ContextTypes.DEFAULT_TYPE)
         response = "Error making request"
         await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
 
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def get_label(result):
+        label = f"{result['title']}: {result['snippet']}"
+        return " ".join(label.split())[:SEARCH_LABEL_LEN]
+
+    try:
+        user_id = await auth(update)
+        if user_id is None:
+            return
+        query = " ".join(context.args)
+        if not query:
+            await update.message.reply_text("Usage: /search <words>")
+            return
+        results = await chatgpt.search(user_id, query)
+        if not results:
+            await update.message.reply_text("Nothing found")
+            return
+
+        keyboard = [
+            [InlineKeyboardButton(get_label(r), callback_data=f"choose:{r['conversation_id']}")]
+            for r in results
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text("Choose a conversation:", reply_markup=reply_markup)
+    except Exception as e:
+        logging.exception("Error handling /search")
+        response = "Error making request"
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+
 async def choose_conversation(chat_id, user_id, query):
     conversation_id = int(query[1])
     title = await chatgpt.select_conversation(user_id, conversation_id)
@@ -184,16 +240,100 @@ async def dalle(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
 
 
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_TG_IDS:
+        logging.warn(f"Profile request from non-admin: tg_id: {update.effective_user.id}")
+        return
+    try:
+        duration = min(int(context.args[0]) if context.args else 30, PROFILE_MAX_SEC)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id, text=f"Profiling for {duration} s"
+        )
+        path = await monitor.monitor.run_profile(duration)
+        response = f"Max event loop lag: {monitor.monitor.max_lag:.3f} s, profile: {path}"
+        with open(path, "rb") as f:
+            await context.bot.send_document(chat_id=update.effective_chat.id, document=f)
+    except Exception as e:
+        logging.exception("Error handling /profile")
+        response = "Error making request"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+
+
+def split_message(text, max_len=MessageLimit.MAX_TEXT_LENGTH):
+    """Split the text into messages short enough for telegram, at line breaks if possible"""
+    parts = []
+    while len(text) > max_len:
+        cut = text.rfind("\n", 0, max_len)
+        if cut <= 0:
+            cut = max_len
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+async def run_turn(bot, job):
+    """Make the journaled turn and deliver the reply"""
+    response = job["response"]
+    if job["state"] != "completed":
+        response = await chatgpt.request(job["user_id"], job["content"], job)
+    try:
+        for part in split_message(response or ""):
+            await bot.send_message(chat_id=job["chat_id"], text=part)
+    except (BadRequest, Forbidden):
+        # Telegram won't take this reply however many times it's resumed
+        await db.set_job_state(job["id"], "failed", expected_state="completed")
+        raise
+    await db.set_job_state(job["id"], "delivered", expected_state="completed")
+
+
 async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = await auth(update)
         if user_id is None:
             return
-        response = await chatgpt.request(user_id, update.message.text)
+        job = await db.create_job(
+            update.update_id,
+            user_id,
+            update.effective_chat.id,
+            update.message.text,
+            time.time_ns(),
+        )
+        if job is None:
+            logging.info(f"Skipping already journaled update {update.update_id}")
+            return
+        await run_turn(context.bot, job)
     except Exception as e:
         logging.exception("Error handling text update")
         response = "Error making request"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
+
+
+async def resume_jobs(application: Application):
+    """Finish the turns interrupted by the previous shutdown"""
+    jobs = await db.get_pending_jobs()
+    if jobs:
+        logging.info(f"Resuming {len(jobs)} journaled turns")
+
+    async def resume(job):
+        try:
+            with tracing.start_trace("bot.resume", job_id=job["id"], update_id=job["update_id"]):
+                await run_turn(application.bot, job)
+        except Exception as e:
+            logging.exception(f"Error resuming job {job['id']}")
+
+    for job in jobs:
+        task = asyncio.create_task(resume(job))
+        resumed_turns.add(task)
+        task.add_done_callback(resumed_turns.discard)
+
+
+async def post_stop(application: Application) -> None:
+    # Handlers in progress are awaited by the application itself
+    if resumed_turns:
+        logging.info(f"Waiting for {len(resumed_turns)} resumed turns")
+        await asyncio.wait(resumed_turns, timeout=DRAIN_TIMEOUT_SEC)
+    await asyncio.to_thread(tracing.close)
 
 
 async def post_init(application: Application) -> None:
@@ -205,6 +345,8 @@ async def post_init(application: Application) -> None:
         dbpass=os.environ["DBPASS"],
     )
     chatgpt.set_db(db)
+    monitor.start(asyncio.get_running_loop())
+    await resume_jobs(application)
 
 
 def main():
@@ -216,20 +358,24 @@ def main():
     builder = ApplicationBuilder()
     builder.token(TG_TOKEN)
     builder.rate_limiter(AIORateLimiter())
+    builder.request(TracedRequest(connection_pool_size=256))
     builder.post_init(post_init)
+    builder.post_stop(post_stop)
     builder.concurrent_updates(True)
     application = builder.build()
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("forget", forget))
-    application.add_handler(CommandHandler("new", new))
-    application.add_handler(CommandHandler("choose", list_conversations))
-    application.add_handler(CommandHandler("model", list_models))
-    application.add_handler(CommandHandler("dalle", dalle))
-    application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(CommandHandler("start", handler(start)))
+    application.add_handler(CommandHandler("forget", handler(forget)))
+    application.add_handler(CommandHandler("new", handler(new)))
+    application.add_handler(CommandHandler("choose", handler(list_conversations)))
+    application.add_handler(CommandHandler("model", handler(list_models)))
+    application.add_handler(CommandHandler("dalle", handler(dalle)))
+    application.add_handler(CommandHandler("search", handler(search)))
+    application.add_handler(CommandHandler("profile", profile))
+    application.add_handler(CallbackQueryHandler(handler(button)))
 
     application.add_handler(
-        MessageHandler(filters.TEXT & (~filters.COMMAND), text_message)
+        MessageHandler(filters.TEXT & (~filters.COMMAND), handler(text_message))
     )
 
     application.run_polling(close_loop=False)
@@ -6,13 +6,64 @@ import tiktoken
 import time
 import asyncio
 import base64
+import bisect
+import collections
 from dataclasses import dataclass
+import functools
 
 import limiter
+from limiter import Priority, percentile
+import tracing
 
 MODEL = "gpt-4o"
 MODEL_DALLE = "dall-e-3"
-MAX_TOKENS = 120000
+
+
+@dataclass
+class ModelInfo:
+    context_window: int
+    encoding: str
+    completion_reserve: int = 4096  # tokens kept free for the reply
+
+
+# Known model families, matched by the longest prefix of the model id
+MODEL_INFO = {
+    "gpt-3.5-turbo": ModelInfo(16385, "cl100k_base"),
+    "gpt-4": ModelInfo(8192, "cl100k_base", 2048),
+    "gpt-4-32k": ModelInfo(32768, "cl100k_base"),
+    "gpt-4-1106": ModelInfo(128000, "cl100k_base"),
+    "gpt-4-0125": ModelInfo(128000, "cl100k_base"),
+    "gpt-4-turbo": ModelInfo(128000, "cl100k_base"),
+    "gpt-4-vision": ModelInfo(128000, "cl100k_base"),
+    "gpt-4o": ModelInfo(128000, "o200k_base", 16384),
+    "chatgpt-4o": ModelInfo(128000, "o200k_base", 16384),
+    "gpt-4.1": ModelInfo(1047576, "o200k_base", 32768),
+    "gpt-4.5": ModelInfo(128000, "o200k_base", 16384),
+    # The 400k window of gpt-5 includes up to 128k of output
+    "gpt-5": ModelInfo(400000, "o200k_base", 128000),
+    "gpt-5-chat": ModelInfo(128000, "o200k_base", 16384),
+    "o1": ModelInfo(200000, "o200k_base", 32768),
+    "o1-mini": ModelInfo(128000, "o200k_base", 32768),
+    "o1-preview": ModelInfo(128000, "o200k_base", 32768),
+    "o3": ModelInfo(200000, "o200k_base", 32768),
+    "o4": ModelInfo(200000, "o200k_base", 32768),
+}
+# Used for models missing from the table: small enough to be safe for any chat model
+DEFAULT_MODEL_INFO = ModelInfo(8192, "cl100k_base", 2048)
+# Models with these in the id can't be used for chat and aren't offered in /model
+NON_CHAT_MODELS = [
+    "dall-e",
+    "whisper",
+    "tts",
+    "embedding",
+    "moderation",
+    "davinci",
+    "babbage",
+    "image",
+    "audio",
+    "realtime",
+    "transcribe",
+]
 
 LIMITS = {
     "requests": 10000,
@@ -20,13 +71,36 @@ LIMITS = {
     "dalle_3_hd": 15,
 }
 LIMITS_INTERVAL_SEC = 60
+# Serve the smallest requests of a class first instead of in arrival order
+LIMITS_SHORTEST_JOB_FIRST = False
+
+# When a chat completion runs longer than this percentile of the recent
+# latencies of its model and prompt size, the request is sent again to the fallback model (or
+# the same one) and the first response wins
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_FALLBACK_MODELS = {}
+# Latencies are tracked separately for prompts of up to these many tokens
+HEDGE_PROMPT_BUCKETS = [1000, 4000, 16000, 64000]
+# Larger prompts are slow anyway and the most expensive to repeat
+HEDGE_MAX_PROMPT_TOKENS = 32000
+# Share of the requests which may be hedged, and how many hedges may be saved up
+HEDGE_BUDGET = 0.05
+HEDGE_BUDGET_BURST = 3
+
+latencies = {}
+hedge_credit = 0.0
 
 db = None
 
 
 async def get_limiter():
     if get_limiter.limiter is None:
-        get_limiter.limiter = limiter.Limiter(LIMITS, LIMITS_INTERVAL_SEC)
+        get_limiter.limiter = limiter.Limiter(
+            LIMITS, LIMITS_INTERVAL_SEC, shortest_job_first=LIMITS_SHORTEST_JOB_FIRST
+        )
     return get_limiter.limiter
 
 
@@ -49,17 +123,19 @@ def set_limiter(new_limiter):
     limiter = new_limiter
 
 
-async def limited(f, volume):
+async def limited(f, volume, priority=Priority.INTERACTIVE):
     try:
         limiter = await get_limiter()
-        return await limiter.run(f, volume)
+        return await limiter.run(f, volume, priority)
     except (
         openai.APITimeoutError,
         openai.RateLimitError,
     ):
         logging.exception("Exception while making request, retry")
         await asyncio.sleep(1)
-        return await limited(f, volume)
+        return await limited(f, volume, Priority.BACKGROUND)
+    except asyncio.CancelledError:
+        raise
     except:
         logging.exception("Exception while making request, drop it")
         raise
@@ -84,7 +160,7 @@ async def dalle(user_id, content) -> DalleResponse | None:
             "dalle_3_hd": 1,
         }
         response = await limited(
-            oai_client.images.generate(
+            traced_images_generate(
                 model=MODEL_DALLE,
                 prompt=content,
                 size="1024x1024",
@@ -92,7 +168,8 @@ async def dalle(user_id, content) -> DalleResponse | None:
                 response_format="b64_json",
                 n=1,
             ),
-            volume
+            volume,
+            Priority.IMAGE,
         )
         resp_timestamp = time.time_ns()
         await db.store_response_timestamp(request_id, resp_timestamp)
@@ -109,49 +186,216 @@ async def dalle(user_id, content) -> DalleResponse | None:
     return None
         
 
+async def traced_images_generate(**kwargs):
+    with tracing.span("openai.images_generate", model=kwargs["model"]):
+        return await oai_client.images.generate(**kwargs)
+
+
 async def get_models():
-    response = await oai_client.models.list()
+    with tracing.span("openai.models_list"):
+        response = await oai_client.models.list()
     logging.debug(response)
     models = [m for m in response.data]
     models = [m for m in models if m.owned_by != "openai-internal"]
+    models = [m for m in models if not any(n in m.id for n in NON_CHAT_MODELS)]
     models = sorted(models, key=lambda m: m.created)
-    return [{"model": m.id, "created": m.created} for m in models]
+    models = [(m, find_model_info(m.id)) for m in models]
+    return [
+        {
+            "model": m.id,
+            "created": m.created,
+            "context_window": None if info is None else info.context_window,
+        }
+        for (m, info) in models
+    ]
+
+
+def find_model_info(model):
+    """Return the info of the longest matching prefix or None if it's unknown"""
+    prefixes = [p for p in MODEL_INFO if model.startswith(p)]
+    if not prefixes:
+        return None
+    return MODEL_INFO[max(prefixes, key=len)]
+
+
+@functools.cache
+def get_model_info(model):
+    info = find_model_info(model)
+    if info is None:
+        logging.warning(f"Unknown model {model}, using default limits")
+        return DEFAULT_MODEL_INFO
+    return info
+
+
+@dataclass
+class Completion:
+    response: object
+    hedged: bool = False
+    hedge_won: bool = False
+    hedge_tokens: int = 0
+
+
+def get_prompt_bucket(prompt_tokens):
+    return bisect.bisect_left(HEDGE_PROMPT_BUCKETS, prompt_tokens)
+
+
+def get_hedge_delay(model, prompt_tokens):
+    if not HEDGE_ENABLED or prompt_tokens > HEDGE_MAX_PROMPT_TOKENS:
+        return None
+    samples = latencies.get((model, get_prompt_bucket(prompt_tokens)), ())
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return percentile(samples, HEDGE_PERCENTILE)
+
+
+def get_hedge_model(model, prompt_tokens):
+    fallback = HEDGE_FALLBACK_MODELS.get(model, model)
+    info = get_model_info(fallback)
+    if prompt_tokens + info.completion_reserve > info.context_window:
+        return model
+    return fallback
+
+
+def take_hedge_budget():
+    global hedge_credit
+    if hedge_credit < 1:
+        return False
+    hedge_credit -= 1
+    return True
 
 
-async def request(user_id, content):
+async def timed_completion(model, messages, prompt_tokens, started):
+    started.set()
+    start = time.monotonic()
+    try:
+        with tracing.span("openai.chat_completion", model=model) as span:
+            response = await oai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+            )
+            span.set(
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens,
+            )
+    except asyncio.CancelledError:
+        # The request lost a hedge, it took at least this long
+        record_latency(model, prompt_tokens, time.monotonic() - start)
+        raise
+    record_latency(model, prompt_tokens, time.monotonic() - start)
+    return response
+
+
+def record_latency(model, prompt_tokens, latency):
+    key = (model, get_prompt_bucket(prompt_tokens))
+    if key not in latencies:
+        latencies[key] = collections.deque(maxlen=HEDGE_WINDOW)
+    latencies[key].append(latency)
+
+
+async def complete(model, messages, volume, prompt_tokens):
+    global hedge_credit
+    hedge_credit = min(hedge_credit + HEDGE_BUDGET, HEDGE_BUDGET_BURST)
+    started = asyncio.Event()
+    primary = asyncio.create_task(
+        limited(timed_completion(model, messages, prompt_tokens, started), volume)
+    )
+    delay = get_hedge_delay(model, prompt_tokens)
+    if delay is None:
+        return Completion(await primary)
+
+    waiter = None
+    hedge = None
+    # Set once the limiter lets the hedge through and charges it
+    hedge_started = asyncio.Event()
+    try:
+        # Start counting once the limiter lets the request through
+        waiter = asyncio.create_task(started.wait())
+        await asyncio.wait([primary, waiter], return_when=asyncio.FIRST_COMPLETED)
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not take_hedge_budget():
+            return Completion(await primary)
+
+        hedge_model = get_hedge_model(model, prompt_tokens)
+        logging.info(f"Hedging request to {model} after {delay:.1f} s with {hedge_model}")
+        hedge = asyncio.create_task(
+            limited(
+                timed_completion(hedge_model, messages, prompt_tokens, hedge_started),
+                volume,
+            )
+        )
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    # A hedge cancelled in the limiter queue was never charged
+                    hedged = hedge_started.is_set()
+                    return Completion(
+                        task.result(),
+                        hedged=hedged,
+                        hedge_won=task is hedge,
+                        hedge_tokens=prompt_tokens if hedged else 0,
+                    )
+        return Completion(primary.result())  # Both failed, raise the error
+    finally:
+        for task in (primary, waiter, hedge):
+            if task is not None:
+                task.cancel()
+
+
+async def request(user_id, content, job=None):
+    """
+    Make a conversation turn. If a journal job is given, its state follows the
+    turn, and a job that was already sent doesn't store the user message again.
+    """
     response_message = "Error making request"
+    job_id = None if job is None else job["id"]
     try:
-        conversation_id = await db.store_message(user_id, content, UserRole.USER.value)
+        if job is not None and job["state"] == "sent":
+            conversation_id = job["conversation_id"]
+        else:
+            conversation_id = await db.store_message(
+                user_id, content, UserRole.USER.value, job_id=job_id, job_state="sent"
+            )
         model = await db.get_user_model(user_id)
         if model is None:
             model = MODEL
-        messages = await db.get_messages(conversation_id, drop_ids_callback)
+        model_info = get_model_info(model)
+        encoding = get_encoding(model)
+        messages = await db.get_messages(
+            conversation_id,
+            lambda messages: drop_ids_callback(messages, model_info, encoding),
+            limit=get_max_prompt_tokens(model_info) // MIN_MESSAGE_TOKENS,
+        )
         messages = [
             {"role": role2str(m["role"]), "content": m["content"]} for m in messages
         ]
-        prompt_tokens = count_conversation_tokens(messages)
+        with tracing.span("chatgpt.count_tokens", messages=len(messages)):
+            prompt_tokens = count_conversation_tokens(messages, encoding)
         timestamp = time.time_ns()
         request_id = await db.store_request(user_id, timestamp, prompt_tokens=prompt_tokens)
         logging.debug(f"Conversation id {conversation_id} messages: {messages}")
+        # Charge the reply budget upfront, the difference is settled below
+        charged_tokens = prompt_tokens + model_info.completion_reserve
         volume = {
             "requests": 1,
-            "tokens": prompt_tokens,
+            "tokens": charged_tokens,
         }
-        response = await limited(
-            oai_client.chat.completions.create(
-                model=model,
-                messages=messages,
-            ),
-            volume,
-        )
+        completion = await complete(model, messages, volume, prompt_tokens)
+        response = completion.response
         resp_timestamp = time.time_ns()
         resp_prompt_tokens = response.usage.prompt_tokens
         resp_completion_tokens = response.usage.completion_tokens
+        if completion.hedged:
+            charged_tokens *= 2
         await adjust_limits(
             {
-                "tokens": max(
-                    0, resp_prompt_tokens + resp_completion_tokens - prompt_tokens
-                )
+                "tokens": resp_prompt_tokens
+                + resp_completion_tokens
+                + completion.hedge_tokens
+                - charged_tokens
             }
         )
         content = response.choices[0].message.content
@@ -162,16 +406,32 @@ async def request(user_id, content):
             "prompt_tokens": prompt_tokens,
             "resp_prompt_tokens": resp_prompt_tokens,
             "resp_completion_tokens": resp_completion_tokens,
+            "hedged": completion.hedged,
+            "hedge_won": completion.hedge_won,
             "content": content,
         }
         logging.debug(f"Request: {request_info}")
-        await db.store_message(user_id, content, int(UserRole.ASSISTANT))
+        await db.store_message(
+            user_id,
+            content,
+            int(UserRole.ASSISTANT),
+            conversation_id,
+            job_id=job_id,
+            job_state="completed",
+        )
         await db.store_response(
-            request_id, resp_timestamp, resp_prompt_tokens, resp_completion_tokens
+            request_id,
+            resp_timestamp,
+            resp_prompt_tokens,
+            resp_completion_tokens,
+            hedge_won=completion.hedge_won if completion.hedged else None,
+            hedge_tokens=completion.hedge_tokens,
         )
         response_message = content
     except Exception as e:
         logging.exception("Error making request")
+        if job_id is not None:
+            await db.set_job_state(job_id, "failed")
     return response_message
 
 
@@ -184,6 +444,9 @@ async def quit_conversation(user_id):
 async def get_conversations_list(user_id):
     return await db.get_conversations_list(user_id)
 
+async def search(user_id, query):
+    return await db.search_messages(user_id, query)
+
 async def select_conversation(user_id, conversation_id):
     title = await db.get_conversation_title(user_id, conversation_id)
     if title is not None:
@@ -201,21 +464,32 @@ def role2str(i):
     return UserRole(i).name.lower()
 
 
-def drop_ids_callback(messages):
-    max_tokens = int(
-        MAX_TOKENS * 0.9
-    )  # Set the max to 90% as our calculation is indicative
-    droplist = []
+def drop_ids_callback(messages, model_info=None, encoding=None):
+    with tracing.span("chatgpt.trim", messages=len(messages)):
+        return get_drop_ids(messages, model_info, encoding)
+
+
+def get_max_prompt_tokens(model_info):
+    # Set the max to 90% as our calculation is indicative
+    return int((model_info.context_window - model_info.completion_reserve) * 0.9)
+
+
+def get_drop_ids(messages, model_info=None, encoding=None):
+    if model_info is None:
+        model_info = get_model_info(MODEL)
+    max_tokens = get_max_prompt_tokens(model_info)
+    kept = 0
     for message in messages[::-1]:
-        tokens = count_message_tokens(message)
-        max_tokens -= tokens
-        if max_tokens >= 0:
-            continue
-        else:
-            droplist.append(message["id"])
-    if len(droplist) == len(messages):
+        max_tokens -= count_message_tokens(message, encoding)
+        if max_tokens < 0:
+            # The older messages are dropped too, no need to count them
+            break
+        kept += 1
+    droplist = [m["id"] for m in messages[: len(messages) - kept]]
+    if messages and kept == 0:
+        message = messages[-1]
         message_len = len(message["content"])
-        tokens = count_message_tokens(message)
+        tokens = count_message_tokens(message, encoding)
         logging.warn(
             f"Message too long! Message length: {message_len} tokens: {tokens}"
         )
@@ -224,14 +498,16 @@ def drop_ids_callback(messages):
 
 
 def get_encoding(model = MODEL):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return encoding
+    return tiktoken.get_encoding(get_model_info(model).encoding)
+
+
+# Tokens taken by a message with empty content
+MIN_MESSAGE_TOKENS = 7
 
 
-def count_message_tokens(message, encoding=get_encoding()):
+def count_message_tokens(message, encoding=None):
+    if encoding is None:
+        encoding = get_encoding()
     num_tokens = 0
     num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
     for key, value in message.items():
@@ -247,8 +523,10 @@ def count_message_tokens(message, encoding=get_encoding()):
     return num_tokens
 
 
-def count_conversation_tokens(messages, encoding=get_encoding()):
+def count_conversation_tokens(messages, encoding=None):
+    if encoding is None:
+        encoding = get_encoding()
     num_tokens = 0
     for message in messages:
-        num_tokens += count_message_tokens(message)
+        num_tokens += count_message_tokens(message, encoding)
     return num_tokens
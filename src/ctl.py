@@ -2,25 +2,258 @@
 
 import argparse
 import asyncio
+import itertools
+import json
+import logging
 import os
+import time
 
 import db_handler
 
 
+async def connect():
+    return await db_handler.DB.create(
+        dbhost=os.environ["DBHOST"],
+        dbname=os.environ["DBNAME"],
+        dbuser=os.environ["DBUSER"],
+        dbpass=os.environ["DBPASS"],
+    )
+
+
 def add_user(args):
     async def wrapper(tg_id):
-        db = await db_handler.DB.create(
-            dbhost=os.environ["DBHOST"],
-            dbname=os.environ["DBNAME"],
-            dbuser=os.environ["DBUSER"],
-            dbpass=os.environ["DBPASS"],
-        )
+        db = await connect()
         await db.add_user(tg_id)
 
     asyncio.run(wrapper(args.tg_id))
 
 
+def retention(args):
+    async def wrapper(days, tables, archive_schema):
+        db = await connect()
+        before = time.time_ns() - days * 24 * 3600 * 10**9
+        for table in tables:
+            await db.ensure_partitions(table)
+            partitions = await db.drop_partitions(table, before, archive_schema)
+            action = "dropped" if archive_schema is None else f"archived to {archive_schema}"
+            logging.info(f"{table}: {action} {len(partitions)} partitions: {partitions}")
+        jobs = await db.delete_jobs(before)
+        logging.info(f"jobs: deleted {jobs} finished jobs")
+
+    asyncio.run(wrapper(args.days, args.tables, args.archive_schema))
+
+
+def backfill_search(args):
+    async def wrapper():
+        db = await connect()
+        rows = await db.backfill_search()
+        logging.info(f"Backfilled search of {rows} messages")
+
+    asyncio.run(wrapper())
+
+
+COPY_BATCH_ROWS = 10000
+
+
+class Throughput:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.rows = 0
+
+    def add(self, table, rows, start):
+        self.rows += rows
+        duration = time.monotonic() - start
+        logging.info(f"{table}: {rows} rows, {rows / max(duration, 1e-6):.0f} rows/s")
+
+    def report(self):
+        duration = time.monotonic() - self.start
+        logging.info(
+            f"Total: {self.rows} rows in {duration:.1f} s, {self.rows / max(duration, 1e-6):.0f} rows/s"
+        )
+
+
+class JsonlReader:
+    """Reads the rows of one table at a time from a JSONL export"""
+
+    def __init__(self, f):
+        self.f = f
+        self.pending = None
+
+    def rows(self, table):
+        while True:
+            line = self.pending or self.f.readline()
+            self.pending = None
+            if not line:
+                return
+            record = json.loads(line)
+            if record["table"] != table:
+                self.pending = line
+                return
+            yield record["row"]
+
+
+def copy_rows(status):
+    return int(status.split()[-1])
+
+
+def export_data(args):
+    async def wrapper(path, data_format, tg_ids):
+        db = await connect()
+        throughput = Throughput()
+
+        async def export_jsonl(f, conn, table, columns, query, query_args):
+            start = time.monotonic()
+            rows = 0
+            async for record in conn.cursor(query, *query_args, prefetch=COPY_BATCH_ROWS):
+                f.write(json.dumps({"table": table, "row": dict(record)}) + "\n")
+                rows += 1
+            throughput.add(table, rows, start)
+
+        async def export_binary(conn, table, columns, query, query_args):
+            start = time.monotonic()
+            status = await conn.copy_from_query(
+                query, *query_args, output=os.path.join(path, f"{table}.copy"), format="binary"
+            )
+            throughput.add(table, copy_rows(status), start)
+
+        if data_format == "jsonl":
+            with open(path, "w") as f:
+                await db.export_data(tg_ids, lambda *a: export_jsonl(f, *a))
+        else:
+            os.makedirs(path, exist_ok=True)
+            await db.export_data(tg_ids, export_binary)
+        throughput.report()
+
+    asyncio.run(wrapper(args.path, args.format, args.tg_id))
+
+
+def import_data(args):
+    async def wrapper(path, data_format):
+        db = await connect()
+        throughput = Throughput()
+
+        async def import_jsonl(reader, conn, table, staging, columns):
+            start = time.monotonic()
+            rows = 0
+            records = (tuple(row[c] for c in columns) for row in reader.rows(table))
+            while batch := list(itertools.islice(records, COPY_BATCH_ROWS)):
+                await conn.copy_records_to_table(staging, records=batch, columns=columns)
+                rows += len(batch)
+            throughput.add(table, rows, start)
+
+        async def import_binary(conn, table, staging, columns):
+            start = time.monotonic()
+            status = await conn.copy_to_table(
+                staging, source=os.path.join(path, f"{table}.copy"), columns=columns, format="binary"
+            )
+            throughput.add(table, copy_rows(status), start)
+
+        if data_format == "jsonl":
+            with open(path) as f:
+                reader = JsonlReader(f)
+                await db.import_data(lambda *a: import_jsonl(reader, *a))
+        else:
+            await db.import_data(import_binary)
+        throughput.report()
+
+    asyncio.run(wrapper(args.path, args.format))
+
+
+def parse_mapping(items, value_type):
+    mapping = {}
+    for item in items or []:
+        key, value = item.split("=")
+        mapping[key] = value_type(value)
+    return mapping
+
+
+def simulate(args):
+    # Imported here as they configure logging at DEBUG level on import
+    import chatgpt
+    import limiter
+
+    async def wrapper(days):
+        db = await connect()
+        since = time.time_ns() - days * 24 * 3600 * 10**9
+        return await db.get_request_history(since)
+
+    history = asyncio.run(wrapper(args.days))
+    if not history:
+        print("No requests in the given period")
+        return
+
+    limits = chatgpt.LIMITS | parse_mapping(args.limit, int)
+    interval = chatgpt.LIMITS_INTERVAL_SEC if args.interval is None else args.interval
+    if args.fifo:
+        weights = {p: 1 for p in limiter.Priority}
+    else:
+        weights = limiter.DEFAULT_WEIGHTS | {
+            limiter.Priority[k.upper()]: v for k, v in parse_mapping(args.weight, float).items()
+        }
+    model = chatgpt.MODEL if args.model is None else args.model
+    reserve = chatgpt.get_model_info(model).completion_reserve
+    requests = []
+    for r in history:
+        arrival = r["request_timestamp"] / 1e9
+        if r["dalle_3_hd_count"] > 0:
+            volume = {"requests": 1, "dalle_3_hd": r["dalle_3_hd_count"]}
+            request = limiter.SimulatedRequest(arrival, limiter.Priority.IMAGE, volume)
+        else:
+            # Charged like chatgpt.request: the prompt and the reply reserve
+            # upfront, settled to the actual usage at the response
+            charged = r["prompt_tokens"] + reserve
+            volume = {"requests": 1, "tokens": charged}
+            request = limiter.SimulatedRequest(
+                arrival,
+                limiter.Priority.INTERACTIVE,
+                volume,
+                hedged=r["hedge_won"] is not None,
+            )
+            if r["response_timestamp"] is not None:
+                request.duration = (r["response_timestamp"] - r["request_timestamp"]) / 1e9
+                used = r["prompt_tokens"] + r["completion_tokens"] + r["hedge_tokens"]
+                charges = 2 if request.hedged else 1
+                request.settle = {"tokens": used - charged * charges}
+        if args.fifo:
+            request.priority = limiter.Priority.INTERACTIVE
+        requests.append(request)
+
+    simulated = limiter.Limiter(limits, interval, weights, args.sjf)
+    waits, end = limiter.simulate(simulated, requests)
+    span = max(end - requests[0].arrival, interval)
+
+    weight_names = {p.name.lower(): w for (p, w) in weights.items()}
+    print(f"Limits {limits} per {interval} s, weights {weight_names}, sjf {args.sjf}")
+    print(f"Reply reserve {reserve} tokens ({model}), settled at the recorded response time")
+    print("The recorded response times include the queueing delay of the deployed limiter")
+    print(
+        f"{len(requests)} requests over {span / 3600:.1f} h, {len(requests) / span * 60:.2f} requests/min"
+    )
+    print("Queueing delay, s:")
+    all_waits = [w for class_waits in waits.values() for w in class_waits]
+    for name, class_waits in [(p.name, waits[p]) for p in waits] + [("ALL", all_waits)]:
+        if not class_waits:
+            continue
+        stats = ", ".join(
+            f"p{p} {limiter.percentile(class_waits, p):.2f}" for p in (50, 90, 99)
+        )
+        print(f"  {name:12} {len(class_waits):8} requests, {stats}, max {max(class_waits):.2f}")
+    print("Utilization:")
+    for dimension, limit in limits.items():
+        used = sum(
+            r.volume.get(dimension, 0) * (2 if r.hedged else 1)
+            + (r.settle or {}).get(dimension, 0)
+            for r in requests
+        )
+        print(f"  {dimension:12} {used / (limit * span / interval):.1%}")
+
+
 if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(required=True)
 
@@ -28,5 +261,87 @@ if __name__ == "__main__":
     add_user_parser.add_argument("tg_id", type=int, help="Telegram id")
     add_user_parser.set_defaults(func=add_user)
 
+    retention_parser = subparsers.add_parser(
+        "retention",
+        help="Detach monthly partitions older than the given age and create upcoming ones",
+    )
+    retention_parser.add_argument("days", type=int, help="Keep rows newer than this many days")
+    retention_parser.add_argument(
+        "--tables",
+        nargs="+",
+        choices=["requests", "messages"],
+        default=["requests"],
+        help="Tables to apply the retention to (default: requests)",
+    )
+    retention_parser.add_argument(
+        "--archive-schema",
+        help="Move detached partitions to this schema instead of dropping them",
+    )
+    retention_parser.set_defaults(func=retention)
+
+    backfill_search_parser = subparsers.add_parser(
+        "backfill_search",
+        help="Index the messages stored before /search was added",
+    )
+    backfill_search_parser.set_defaults(func=backfill_search)
+
+    export_parser = subparsers.add_parser(
+        "export", help="Export users with their conversations, messages and requests"
+    )
+    export_parser.add_argument(
+        "path", help="Output file for jsonl, output directory for binary"
+    )
+    export_parser.add_argument("--format", choices=["jsonl", "binary"], default="jsonl")
+    export_parser.add_argument(
+        "--tg-id", type=int, nargs="+", help="Export only these users (default: all)"
+    )
+    export_parser.set_defaults(func=export_data)
+
+    import_parser = subparsers.add_parser(
+        "import", help="Import an export made by the export command, assigning new ids"
+    )
+    import_parser.add_argument(
+        "path", help="Input file for jsonl, input directory for binary"
+    )
+    import_parser.add_argument("--format", choices=["jsonl", "binary"], default="jsonl")
+    import_parser.set_defaults(func=import_data)
+
+    simulate_parser = subparsers.add_parser(
+        "simulate",
+        help="Replay the recorded requests through the limiter on a virtual clock",
+    )
+    simulate_parser.add_argument(
+        "--days", type=int, default=7, help="Replay the requests of this many last days"
+    )
+    simulate_parser.add_argument(
+        "--limit",
+        nargs="+",
+        metavar="NAME=VALUE",
+        help="Override limits, e.g. tokens=1000000 dalle_3_hd=5",
+    )
+    simulate_parser.add_argument(
+        "--interval",
+        type=float,
+        help="Override the interval the limits apply to, in seconds",
+    )
+    simulate_parser.add_argument(
+        "--model",
+        help="Model whose reply reserve is charged upfront (default: the bot's default model)",
+    )
+    simulate_parser.add_argument(
+        "--weight",
+        nargs="+",
+        metavar="CLASS=WEIGHT",
+        help="Override priority class weights, e.g. image=4",
+    )
+    order_group = simulate_parser.add_mutually_exclusive_group()
+    order_group.add_argument(
+        "--sjf", action="store_true", help="Serve the shortest requests of a class first"
+    )
+    order_group.add_argument(
+        "--fifo", action="store_true", help="Serve all requests in arrival order"
+    )
+    simulate_parser.set_defaults(func=simulate)
+
     args = parser.parse_args()
     args.func(args)
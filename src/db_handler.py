@@ -1,7 +1,49 @@
 import asyncpg
+import datetime
 import logging
-
-
+import re
+
+import tracing
+
+# Monthly partitions are created this far into the future on startup
+PARTITION_MONTHS_AHEAD = 12
+
+# Text search configuration of the message search, "simple" doesn't stem
+# words so it works the same for any language
+SEARCH_CONFIG = "simple"
+SEARCH_RESULTS = 10
+# Only this many of the newest matching messages are grouped into results
+SEARCH_CANDIDATES = 1000
+SEARCH_BACKFILL_BATCH_ROWS = 10000
+
+# Exported columns and per-user filter of each table, in the import order
+EXPORT_TABLES = {
+    "users": (["id", "tg_id"], "id = ANY($1)"),
+    "conversations": (["id", "user_id", "title"], "user_id = ANY($1)"),
+    "current_conversations": (["id", "user_id"], "user_id = ANY($1)"),
+    "models": (["user_id", "model"], "user_id = ANY($1)"),
+    "messages": (
+        ["id", "conversation_id", "role", "content", "created_at"],
+        "conversation_id IN (SELECT id FROM conversations WHERE user_id = ANY($1))",
+    ),
+    "requests": (
+        [
+            "id",
+            "user_id",
+            "request_timestamp",
+            "response_timestamp",
+            "prompt_tokens",
+            "completion_tokens",
+            "dalle_3_hd_count",
+            "hedge_won",
+            "hedge_tokens",
+        ],
+        "user_id = ANY($1)",
+    ),
+}
+
+
+@tracing.traced_methods("db")
 class DB:
     @classmethod
     async def create(cls, dbhost, dbname, dbuser, dbpass):
@@ -53,29 +95,83 @@ class DB:
             """
         )
 
-        await create_table(
+        await self.create_partitioned_table(
             "messages",
             """
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             conversation_id INTEGER REFERENCES conversations(id),
-            role INTEGER CHECK (role IN (0, 1, 2)),
-            content TEXT
+            role INTEGER CONSTRAINT messages_role_check CHECK (role IN (0, 1, 2)),
+            content TEXT,
+            created_at BIGINT NOT NULL
+                DEFAULT (extract(epoch FROM now()) * 1000000000)::BIGINT,
+            PRIMARY KEY (id, created_at)
             """,
+            "created_at",
+            [
+                # Denormalized from conversations, so the search can be
+                # narrowed to the user before matching the text. Both columns
+                # are set on insert; rows stored before they were added are
+                # filled by `ctl.py backfill_search`.
+                "user_id INTEGER",
+                "search TSVECTOR",
+            ],
+            legacy_prepare=[
+                """
+                ADD COLUMN created_at BIGINT NOT NULL
+                    DEFAULT (extract(epoch FROM now()) * 1000000000)::BIGINT
+                """,
+            ],
+        )
+        await self.execute(
+            """
+            CREATE INDEX IF NOT EXISTS messages_conversation_id_idx
+            ON messages (conversation_id, id)
+            """
+        )
+        # btree_gin lets the GIN index lead with the plain user_id column
+        await self.execute("CREATE EXTENSION IF NOT EXISTS btree_gin")
+        await self.execute(
+            """
+            CREATE INDEX IF NOT EXISTS messages_user_search_idx
+            ON messages USING GIN (user_id, search)
+            """
+        )
+        # Only holds the messages waiting for the backfill, so it stays empty
+        await self.execute(
+            """
+            CREATE INDEX IF NOT EXISTS messages_search_missing_idx
+            ON messages (id) WHERE search IS NULL
+            """
         )
+        async with self.pool.acquire() as conn:
+            missing = await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM messages WHERE search IS NULL)"
+            )
+        if missing:
+            logging.warning(
+                "Some messages aren't indexed for /search, run `ctl.py backfill_search`"
+            )
 
-        await create_table(
+        await self.create_partitioned_table(
             "requests",
             """
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             user_id INTEGER REFERENCES users(id),
-            request_timestamp BIGINT,
+            request_timestamp BIGINT NOT NULL,
             response_timestamp BIGINT,
             prompt_tokens INTEGER,
-            completion_tokens INTEGER
+            completion_tokens INTEGER,
+            PRIMARY KEY (id, request_timestamp)
             """,
+            "request_timestamp",
             [
-                "dalle_3_hd_count INTEGER"
-            ]
+                "dalle_3_hd_count INTEGER",
+                "hedge_won BOOLEAN",
+                "hedge_tokens INTEGER",
+            ],
+            legacy_prepare=[
+                "ALTER COLUMN request_timestamp SET NOT NULL",
+            ],
         )
 
         await create_table(
@@ -86,6 +182,171 @@ class DB:
             """,
         )
 
+        await create_table(
+            "jobs",
+            """
+            id SERIAL PRIMARY KEY,
+            update_id BIGINT UNIQUE,
+            user_id INTEGER REFERENCES users(id),
+            chat_id BIGINT,
+            content TEXT,
+            conversation_id INTEGER,
+            state TEXT CHECK (state IN ('queued', 'sent', 'completed', 'delivered', 'failed')),
+            response TEXT,
+            created_at BIGINT
+            """,
+        )
+        await self.execute(
+            """
+            CREATE INDEX IF NOT EXISTS jobs_pending_idx ON jobs (id)
+            WHERE state IN ('queued', 'sent', 'completed')
+            """
+        )
+
+    async def create_partitioned_table(
+        self, name, query, key, add_columns=[], legacy_prepare=[]
+    ):
+        """
+        Create a table range-partitioned by month on the nanosecond timestamp
+        column `key`. An existing plain table with the same name is kept as
+        the `<name>_legacy` partition covering everything up to the end of
+        the current month, so the migration doesn't copy any rows.
+
+        ATTACH PARTITION matches CHECK constraints by name, so `query` must
+        name them explicitly like the existing table does. Otherwise the new
+        ones get a numbered name, as the legacy table keeps the default one.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                kind = await conn.fetchval(
+                    "SELECT relkind::TEXT FROM pg_class WHERE oid = to_regclass($1)", name
+                )
+                legacy = None
+                if kind == "r":
+                    legacy = f"{name}_legacy"
+                    logging.info(f"Migrating table {name} to partitioned {legacy}")
+                    await conn.execute(f"ALTER TABLE {name} RENAME TO {legacy}")
+                    # The primary key of the parent, which includes the
+                    # partition key, replaces it when the table is attached
+                    await conn.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {name}_pkey")
+
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} ( {query} ) PARTITION BY RANGE ({key})"
+                )
+                for column in add_columns:
+                    await conn.execute(
+                        f"ALTER TABLE {name} ADD COLUMN IF NOT EXISTS {column}"
+                    )
+
+                if legacy is not None:
+                    for statement in legacy_prepare:
+                        await conn.execute(f"ALTER TABLE {legacy} {statement}")
+                    for column in add_columns:
+                        await conn.execute(
+                            f"ALTER TABLE {legacy} ADD COLUMN IF NOT EXISTS {column}"
+                        )
+                    # Continue the ids where the old table stopped
+                    await conn.execute(
+                        f"""
+                        SELECT setval(
+                            pg_get_serial_sequence('{name}', 'id'),
+                            (SELECT coalesce(max(id), 0) + 1 FROM {legacy}),
+                            false
+                        )
+                        """
+                    )
+                    upper = month_start_ns(*next_month(*current_month()))
+                    await conn.execute(
+                        f"""
+                        ALTER TABLE {name} ATTACH PARTITION {legacy}
+                        FOR VALUES FROM (MINVALUE) TO ({upper})
+                        """
+                    )
+            logging.info(f"Created partitioned table {name}")
+        await self.ensure_partitions(name)
+
+    async def get_partitions(self, conn, name):
+        """
+        Return (partition name, lower bound, upper bound) tuples ordered by the
+        upper bound. The lower bound is None for MINVALUE.
+        """
+        rows = await conn.fetch(
+            """
+            SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass($1)
+            """,
+            name,
+        )
+        partitions = []
+        for row in rows:
+            bounds = re.search(
+                r"FROM \((MINVALUE|'?-?\d+'?)\) TO \('?(-?\d+)'?\)", row["bound"]
+            )
+            lower = bounds.group(1).strip("'")
+            lower = None if lower == "MINVALUE" else int(lower)
+            partitions.append((row["name"], lower, int(bounds.group(2))))
+        return sorted(partitions, key=lambda p: p[2])
+
+    async def create_partitions(
+        self, conn, name, since=None, months_ahead=PARTITION_MONTHS_AHEAD
+    ):
+        """
+        Create the missing monthly partitions of `name` from the month of the
+        `since` ns timestamp (default: now) up to `months_ahead` months ahead.
+        """
+        partitions = await self.get_partitions(conn, name)
+        year, month = current_month()
+        for _ in range(months_ahead + 1):
+            year, month = next_month(year, month)
+        end = month_start_ns(year, month)
+        if since is None:
+            year, month = current_month()
+        else:
+            start = datetime.datetime.fromtimestamp(since / 1e9, datetime.timezone.utc)
+            year, month = start.year, start.month
+        while (lower := month_start_ns(year, month)) < end:
+            year, month = next_month(year, month)
+            upper = month_start_ns(year, month)
+            overlaps = any(
+                lower < p_upper and (p_lower is None or p_lower < upper)
+                for (_, p_lower, p_upper) in partitions
+            )
+            if overlaps:
+                continue
+            await conn.execute(
+                f"""
+                CREATE TABLE {partition_name(name, lower)} PARTITION OF {name}
+                FOR VALUES FROM ({lower}) TO ({upper})
+                """
+            )
+
+    async def ensure_partitions(self, name, since=None):
+        async with self.pool.acquire() as conn:
+            await self.create_partitions(conn, name, since)
+
+    async def drop_partitions(self, name, before, archive_schema=None):
+        """
+        Detach the partitions of `name` holding only rows older than `before`
+        (ns timestamp) and either drop them or move them to `archive_schema`.
+        Returns the names of the detached partitions.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                partitions = await self.get_partitions(conn, name)
+                detached = [p for (p, _, upper) in partitions if upper <= before]
+                if archive_schema is not None and detached:
+                    await conn.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+                for partition in detached:
+                    await conn.execute(f"ALTER TABLE {name} DETACH PARTITION {partition}")
+                    if archive_schema is None:
+                        await conn.execute(f"DROP TABLE {partition}")
+                    else:
+                        await conn.execute(
+                            f"ALTER TABLE {partition} SET SCHEMA {archive_schema}"
+                        )
+                return detached
+
     async def add_user(self, tg_id):
         async with self.pool.acquire() as conn:
             user_id = await conn.fetchval(
@@ -130,10 +391,23 @@ class DB:
                 )
                 return conversation_id
 
-    async def store_message(self, user_id: int, content: str, role: int):
+    async def store_message(
+        self,
+        user_id: int,
+        content: str,
+        role: int,
+        conversation_id: int | None = None,
+        job_id: int | None = None,
+        job_state: str | None = None,
+    ):
+        """
+        Store the message in the given or the current conversation. If job_id
+        is given, the job moves to job_state in the same transaction.
+        """
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                conversation_id = await self.get_current_conversation(user_id)
+                if conversation_id is None:
+                    conversation_id = await self.get_current_conversation(user_id)
                 if conversation_id is None:
                     title = get_title(content)
                     logging.debug(f"User id {user_id} title {title}")
@@ -142,32 +416,54 @@ class DB:
                     await self.set_current_conversation(user_id, conversation_id)
 
                 message_id = await conn.fetchval(
-                    """
-                    INSERT INTO messages (conversation_id, role, content)
-                    VALUES ($1, $2, $3)
+                    f"""
+                    INSERT INTO messages (conversation_id, role, content, user_id, search)
+                    VALUES ($1, $2, $3, $4, to_tsvector('{SEARCH_CONFIG}', coalesce($3, '')))
                     RETURNING id""",
                     conversation_id,
                     role,
                     content,
+                    user_id,
                 )
                 assert message_id is not None
 
+                if job_id is not None:
+                    await conn.execute(
+                        """
+                        UPDATE jobs
+                        SET state = $2, conversation_id = $3,
+                            response = CASE WHEN $2 = 'completed' THEN $4 END
+                        WHERE id = $1
+                        """,
+                        job_id,
+                        job_state,
+                        conversation_id,
+                        content,
+                    )
+
                 return conversation_id
 
-    async def get_messages(self, conversation_id, drop_ids_callback):
+    async def get_messages(self, conversation_id, drop_ids_callback, limit=None):
+        """Return the `limit` newest messages of the conversation, oldest first"""
         async with self.pool.acquire() as conn:
             messages = await conn.fetch(
                 """
-                SELECT id, role, content FROM messages
-                WHERE conversation_id = $1
+                SELECT id, role, content FROM (
+                    SELECT id, role, content FROM messages
+                    WHERE conversation_id = $1
+                    ORDER BY id DESC
+                    LIMIT $2
+                ) m
                 ORDER BY id
                 """,
                 conversation_id,
+                limit,
             )
             messages = [dict(m) for m in messages]
-            drop_ids = drop_ids_callback(messages)
+            # Only leave the dropped messages out of the prompt, they are kept
+            # for models with a larger context and for the search
+            drop_ids = set(drop_ids_callback(messages))
             if len(drop_ids) > 0:
-                await conn.execute("DELETE FROM messages WHERE id = ANY($1)", drop_ids)
                 messages = [m for m in messages if m["id"] not in drop_ids]
             return messages
 
@@ -258,6 +554,98 @@ class DB:
                 
                 return conversations
 
+    async def search_messages(self, user_id, query):
+        """
+        Return the conversations of the user with messages matching the query,
+        the newest match first, with a snippet of the matching message
+        """
+        async with self.pool.acquire() as conn:
+            results = await conn.fetch(
+                f"""
+                SELECT
+                    r.conversation_id,
+                    r.title,
+                    ts_headline(
+                        '{SEARCH_CONFIG}', r.content, r.query,
+                        'StartSel=«, StopSel=», MaxWords=10, MinWords=3'
+                    ) AS snippet
+                FROM (
+                    SELECT DISTINCT ON (m.conversation_id)
+                        m.conversation_id, m.id, m.content, c.title, m.query
+                    FROM (
+                        SELECT m.conversation_id, m.id, m.content, q.query
+                        FROM websearch_to_tsquery('{SEARCH_CONFIG}', $2) AS q(query),
+                            messages m
+                        WHERE m.user_id = $1 AND m.search @@ q.query
+                        ORDER BY m.id DESC
+                        LIMIT {SEARCH_CANDIDATES}
+                    ) m JOIN conversations c ON c.id = m.conversation_id
+                    ORDER BY m.conversation_id, m.id DESC
+                ) r
+                ORDER BY r.id DESC
+                LIMIT {SEARCH_RESULTS}
+                """,
+                user_id,
+                query,
+            )
+            results = [dict(r) for r in results]
+            for result in results:
+                if result["title"] is None:
+                    result["title"] = get_default_title(result["conversation_id"])
+            return results
+
+    async def backfill_search(self):
+        """
+        Fill user_id and search of the messages stored before these columns
+        were added. The table is walked in id ranges, each updated in its own
+        transaction so the table isn't locked for long. Returns the number of
+        updated rows.
+        """
+        async with self.pool.acquire() as conn:
+            first, last = await conn.fetchrow(
+                "SELECT min(id), max(id) FROM messages WHERE search IS NULL"
+            )
+        updated = 0
+        if first is None:
+            return updated
+        for start in range(first, last + 1, SEARCH_BACKFILL_BATCH_ROWS):
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(
+                    f"""
+                    UPDATE messages m
+                    SET user_id = (
+                            SELECT user_id FROM conversations c WHERE c.id = m.conversation_id
+                        ),
+                        search = to_tsvector('{SEARCH_CONFIG}', coalesce(m.content, ''))
+                    WHERE m.id >= $1 AND m.id < $2 AND m.search IS NULL
+                    """,
+                    start,
+                    start + SEARCH_BACKFILL_BATCH_ROWS,
+                )
+            updated += int(status.split()[-1])
+            logging.info(f"Backfilled search of {updated} messages")
+        return updated
+
+    async def get_request_history(self, since):
+        """Return the requests made since the ns timestamp in time order"""
+        async with self.pool.acquire() as conn:
+            requests = await conn.fetch(
+                """
+                SELECT
+                    request_timestamp,
+                    response_timestamp,
+                    coalesce(prompt_tokens, 0) AS prompt_tokens,
+                    coalesce(completion_tokens, 0) AS completion_tokens,
+                    coalesce(dalle_3_hd_count, 0) AS dalle_3_hd_count,
+                    hedge_won,
+                    coalesce(hedge_tokens, 0) AS hedge_tokens
+                FROM requests
+                WHERE request_timestamp >= $1
+                ORDER BY request_timestamp
+                """,
+                since,
+            )
+            return [dict(r) for r in requests]
 
     async def store_request(self, user_id, timestamp, prompt_tokens=0, dalle_3_hd_count=0):
         async with self.pool.acquire() as conn:
@@ -276,19 +664,29 @@ class DB:
             return request_id
 
     async def store_response(
-        self, request_id, timestamp, prompt_tokens, completion_tokens
+        self,
+        request_id,
+        timestamp,
+        prompt_tokens,
+        completion_tokens,
+        hedge_won=None,
+        hedge_tokens=0,
     ):
+        """hedge_won is None if the request wasn't hedged"""
         async with self.pool.acquire() as conn:
             await conn.execute(
                 """
                 UPDATE requests
-                SET response_timestamp = $1, prompt_tokens = $2, completion_tokens = $3
+                SET response_timestamp = $1, prompt_tokens = $2, completion_tokens = $3,
+                    hedge_won = $5, hedge_tokens = $6
                 WHERE id = $4
                 """,
                 timestamp,
                 prompt_tokens,
                 completion_tokens,
                 request_id,
+                hedge_won,
+                hedge_tokens,
             )
 
     async def store_response_timestamp(
@@ -305,6 +703,163 @@ class DB:
                 request_id,
             )
     
+    async def export_data(self, tg_ids, export_table):
+        """
+        Call `export_table(conn, table, columns, query, args)` for every table
+        in EXPORT_TABLES from a single snapshot. `query` selects the rows of
+        the users with the given telegram ids, or of all users if None.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                user_ids = None
+                if tg_ids is not None:
+                    user_ids = await conn.fetchval(
+                        "SELECT array_agg(id) FROM users WHERE tg_id = ANY($1)", tg_ids
+                    )
+                    user_ids = user_ids or []
+                for table, (columns, where) in EXPORT_TABLES.items():
+                    query = f"""
+                        SELECT {", ".join(columns)} FROM {table}
+                        WHERE $1::INTEGER[] IS NULL OR {where}
+                        """
+                    await export_table(conn, table, columns, query, [user_ids])
+
+    async def import_data(self, import_table):
+        """
+        Call `import_table(conn, table, staging_table, columns)` for every table
+        in EXPORT_TABLES to load the rows into a temporary staging table, then
+        insert them with new ids in the same transaction. Users are matched by
+        telegram id, the existing current conversation and model are kept.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for table, (columns, _) in EXPORT_TABLES.items():
+                    staging = f"import_{table}"
+                    await conn.execute(
+                        f"""
+                        CREATE TEMP TABLE {staging} ON COMMIT DROP AS
+                        SELECT {", ".join(columns)} FROM {table} WITH NO DATA
+                        """
+                    )
+                    await import_table(conn, table, staging, columns)
+
+                for name, key in [("messages", "created_at"), ("requests", "request_timestamp")]:
+                    since = await conn.fetchval(f"SELECT min({key}) FROM import_{name}")
+                    if since is not None:
+                        await self.create_partitions(conn, name, since)
+
+                await conn.execute(
+                    f"""
+                    INSERT INTO users (tg_id) SELECT tg_id FROM import_users
+                    ON CONFLICT (tg_id) DO NOTHING;
+
+                    CREATE TEMP TABLE user_map ON COMMIT DROP AS
+                    SELECT i.id AS old_id, u.id AS new_id
+                    FROM import_users i JOIN users u ON u.tg_id = i.tg_id;
+
+                    CREATE TEMP TABLE conversation_map ON COMMIT DROP AS
+                    SELECT
+                        id AS old_id,
+                        nextval(pg_get_serial_sequence('conversations', 'id'))::INTEGER AS new_id
+                    FROM import_conversations;
+
+                    INSERT INTO conversations (id, user_id, title)
+                    SELECT c.new_id, u.new_id, i.title
+                    FROM import_conversations i
+                    JOIN conversation_map c ON c.old_id = i.id
+                    JOIN user_map u ON u.old_id = i.user_id;
+
+                    INSERT INTO current_conversations (id, user_id)
+                    SELECT c.new_id, u.new_id
+                    FROM import_current_conversations i
+                    JOIN conversation_map c ON c.old_id = i.id
+                    JOIN user_map u ON u.old_id = i.user_id
+                    ON CONFLICT (user_id) DO NOTHING;
+
+                    INSERT INTO models (user_id, model)
+                    SELECT u.new_id, i.model
+                    FROM import_models i JOIN user_map u ON u.old_id = i.user_id
+                    ON CONFLICT (user_id) DO NOTHING;
+
+                    INSERT INTO messages (
+                        conversation_id, role, content, created_at, user_id, search
+                    )
+                    SELECT
+                        c.new_id, i.role, i.content, i.created_at, u.new_id,
+                        to_tsvector('{SEARCH_CONFIG}', coalesce(i.content, ''))
+                    FROM import_messages i
+                    JOIN conversation_map c ON c.old_id = i.conversation_id
+                    JOIN import_conversations ic ON ic.id = i.conversation_id
+                    JOIN user_map u ON u.old_id = ic.user_id
+                    ORDER BY i.id;
+
+                    INSERT INTO requests (
+                        user_id, request_timestamp, response_timestamp,
+                        prompt_tokens, completion_tokens, dalle_3_hd_count,
+                        hedge_won, hedge_tokens
+                    )
+                    SELECT
+                        u.new_id, i.request_timestamp, i.response_timestamp,
+                        i.prompt_tokens, i.completion_tokens, i.dalle_3_hd_count,
+                        i.hedge_won, i.hedge_tokens
+                    FROM import_requests i JOIN user_map u ON u.old_id = i.user_id
+                    ORDER BY i.id;
+                    """
+                )
+
+    async def create_job(self, update_id, user_id, chat_id, content, timestamp):
+        """Journal a new turn, returns None if the update was already seen"""
+        async with self.pool.acquire() as conn:
+            job = await conn.fetchrow(
+                """
+                INSERT INTO jobs (update_id, user_id, chat_id, content, state, created_at)
+                VALUES ($1, $2, $3, $4, 'queued', $5)
+                ON CONFLICT (update_id) DO NOTHING
+                RETURNING *
+                """,
+                update_id,
+                user_id,
+                chat_id,
+                content,
+                timestamp,
+            )
+            return None if job is None else dict(job)
+
+    async def get_pending_jobs(self):
+        async with self.pool.acquire() as conn:
+            jobs = await conn.fetch(
+                """
+                SELECT * FROM jobs
+                WHERE state IN ('queued', 'sent', 'completed')
+                ORDER BY id
+                """
+            )
+            return [dict(j) for j in jobs]
+
+    async def set_job_state(self, job_id, state, expected_state=None):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                UPDATE jobs SET state = $2
+                WHERE id = $1 AND ($3::TEXT IS NULL OR state = $3)
+                """,
+                job_id,
+                state,
+                expected_state,
+            )
+
+    async def delete_jobs(self, before):
+        """Delete finished jobs created before the ns timestamp"""
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                """
+                DELETE FROM jobs
+                WHERE created_at < $1 AND state IN ('delivered', 'failed')
+                """,
+                before,
+            )
+            return int(status.split()[-1])
+
 
 def get_title(message: str):
     max_title_len = 50
@@ -322,3 +877,20 @@ def get_title(message: str):
 
 def get_default_title(conversation_id):
     return f"Conversation {conversation_id}"
+
+def current_month():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.year, now.month
+
+def next_month(year, month):
+    if month == 12:
+        return year + 1, 1
+    return year, month + 1
+
+def month_start_ns(year, month):
+    start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+    return int(start.timestamp()) * 10**9
+
+def partition_name(name, lower):
+    start = datetime.datetime.fromtimestamp(lower / 1e9, datetime.timezone.utc)
+    return f"{name}_y{start.year}m{start.month:02d}"
@@ -1,6 +1,12 @@
-import time
 import asyncio
+import heapq
+import itertools
 import logging
+import selectors
+from dataclasses import dataclass
+from enum import IntEnum
+
+import tracing
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -8,32 +14,187 @@ logging.basicConfig(
 )
 
 
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    IMAGE = 1
+    BACKGROUND = 2
+
+
+# Share of the limits each priority class gets while several are waiting
+DEFAULT_WEIGHTS = {
+    Priority.INTERACTIVE: 8,
+    Priority.IMAGE: 2,
+    Priority.BACKGROUND: 1,
+}
+
+
+class FairQueue:
+    """
+    Weighted fair queue over the priority classes: every backlogged class gets
+    a share of the limiter time proportional to its weight. Within a class the
+    jobs are served in arrival order, or shortest first if requested.
+    """
+
+    def __init__(self, weights=None, shortest_job_first=False):
+        self.weights = DEFAULT_WEIGHTS if weights is None else weights
+        self.shortest_job_first = shortest_job_first
+        self.queues = {p: [] for p in self.weights}
+        self.finish = {p: 0.0 for p in self.weights}
+        self.virtual_time = 0.0
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def push(self, priority, duration, item):
+        key = duration if self.shortest_job_first else 0
+        heapq.heappush(self.queues[priority], (key, next(self.counter), duration, item))
+
+    def pop(self):
+        best = None
+        for priority, queue in self.queues.items():
+            if not queue:
+                continue
+            start = max(self.virtual_time, self.finish[priority])
+            finish = start + queue[0][2] / self.weights[priority]
+            if best is None or finish < best[0]:
+                best = (finish, start, priority)
+        finish, start, priority = best
+        self.virtual_time = start
+        self.finish[priority] = finish
+        _, _, duration, item = heapq.heappop(self.queues[priority])
+        return priority, duration, item
+
+
 class Limiter:
-    def __init__(self, limits, interval):
+    def __init__(self, limits, interval, weights=None, shortest_job_first=False):
         self.time_per_volume = {k: interval / v for (k, v) in limits.items()}
         logging.debug(
             f"Limiter: init with limits {limits}, interval {interval}, time per volume {self.time_per_volume}"
         )
 
-        self.next = time.monotonic()
+        # In the event loop time, so the limiter also runs on a virtual clock
+        self.next = 0.0
         self.lock = asyncio.Lock()
+        self.queue = FairQueue(weights, shortest_job_first)
+        self.dispatcher = None
 
-    async def run(self, f, volume):
-        duration = max((v * self.time_per_volume[k] for (k, v) in volume.items()))
-        now = time.monotonic()
-        async with self.lock:
-            target = max(self.next, now)
-            self.next = target + duration
-        to_sleep = target - now
+    def get_duration(self, volume):
+        return max((v * self.time_per_volume[k] for (k, v) in volume.items()))
+
+    async def run(self, f, volume, priority=Priority.INTERACTIVE):
+        duration = self.get_duration(volume)
+        ready = asyncio.get_running_loop().create_future()
+        self.queue.push(priority, duration, ready)
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
         logging.debug(
-            f"Limiter: run with volume {volume}, duration {duration}, now {now}, sleep until {target}"
+            f"Limiter: run with volume {volume}, priority {priority.name}, duration {duration}, queued {len(self.queue)}"
         )
-        if to_sleep > 0:
-            await asyncio.sleep(to_sleep)
+        with tracing.span("limiter.wait", priority=priority.name, duration=duration):
+            await ready
         return await f
 
+    async def dispatch(self):
+        try:
+            while len(self.queue) > 0:
+                loop = asyncio.get_running_loop()
+                while (to_sleep := self.next - loop.time()) > 0:
+                    await asyncio.sleep(to_sleep)
+                _, duration, ready = self.queue.pop()
+                if ready.done():  # The caller was cancelled while waiting
+                    continue
+                async with self.lock:
+                    self.next = max(self.next, loop.time()) + duration
+                ready.set_result(None)
+        finally:
+            self.dispatcher = None
+
     async def alloc(self, volume):
-        duration = max((v * self.time_per_volume[k] for (k, v) in volume.items()))
+        duration = self.get_duration(volume)
         logging.debug(f"Limiter: alloc with volume {volume}, duration {duration}")
         async with self.lock:
             self.next += duration
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop on a virtual clock: whenever every task is waiting, the clock
+    jumps to the next timer instead of sleeping
+    """
+
+    def __init__(self):
+        # Starts from 0 like the monotonic clock: near unix time the loop's
+        # 1 ns clock resolution is lost in rounding and due timers never run
+        self.now = 0.0
+        super().__init__(VirtualClockSelector(self))
+
+    def time(self):
+        return self.now
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.loop.now += timeout
+        return events
+
+
+@dataclass
+class SimulatedRequest:
+    arrival: float
+    priority: Priority
+    volume: dict  # Charged when the limiter lets the request through
+    duration: float = 0.0  # From being let through to the response
+    settle: dict | None = None  # Passed to Limiter.alloc at the response
+    hedged: bool = False  # A hedge with the same volume is queued once it's let through
+
+
+def simulate(limiter, requests):
+    """
+    Replay the requests through the limiter, the same queue and dispatcher
+    the bot uses, on a virtual clock. Returns the queueing delay of every
+    request by priority and the time the last one was let through.
+    """
+    loop = VirtualClockLoop()
+    origin = min((r.arrival for r in requests), default=0.0)
+    waits = {p: [] for p in limiter.queue.weights}
+    end = origin
+    hedges = []
+
+    async def respond(request):
+        nonlocal end
+        end = origin + loop.time()
+        waits[request.priority].append(end - request.arrival)
+        if request.hedged:
+            hedge = limiter.run(asyncio.sleep(0), request.volume)
+            hedges.append(asyncio.create_task(hedge))
+        await asyncio.sleep(request.duration)
+        if request.settle:
+            await limiter.alloc(request.settle)
+
+    async def replay(request):
+        await asyncio.sleep(request.arrival - origin - loop.time())
+        await limiter.run(respond(request), request.volume, request.priority)
+
+    async def replay_all():
+        await asyncio.gather(*(replay(r) for r in requests))
+        await asyncio.gather(*hedges)
+
+    try:
+        loop.run_until_complete(replay_all())
+    finally:
+        loop.close()
+    return waits, end
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
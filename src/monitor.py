@@ -0,0 +1,136 @@
+import asyncio
+import collections
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# Event loop heartbeat period and the stall that is reported as slow
+LAG_INTERVAL_SEC = 0.1
+LAG_THRESHOLD_SEC = 0.25
+
+PROFILE_RATE_HZ = 100
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp")
+
+monitor = None
+
+
+def handler(f):
+    """
+    Mark a telegram handler, so a stalled event loop can be attributed to the
+    handler and update being executed
+    """
+
+    @functools.wraps(f)
+    async def monitored_handler(update, context):
+        return await f(update, context)
+
+    return monitored_handler
+
+
+def find_handler(frame):
+    """Return (handler name, update id) of the handler running in the frame stack"""
+    while frame is not None:
+        if frame.f_code.co_name == "monitored_handler" and frame.f_globals is globals():
+            f_locals = frame.f_locals
+            update = f_locals.get("update")
+            return f_locals["f"].__name__, getattr(update, "update_id", None)
+        frame = frame.f_back
+    return None, None
+
+
+class LoopMonitor:
+    def __init__(self, loop, interval=LAG_INTERVAL_SEC, threshold=LAG_THRESHOLD_SEC):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.max_lag = 0.0
+        self.profiling = threading.Lock()
+
+    def start(self):
+        self.probe = self.loop.create_task(self.lag_probe())
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+
+    async def lag_probe(self):
+        while True:
+            start = time.monotonic()
+            self.beat = start
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                logging.warning(f"Event loop lag {lag:.3f} s")
+
+    def watchdog(self):
+        reported = None
+        while True:
+            time.sleep(self.interval)
+            beat = self.beat
+            # The probe is due to beat again one interval after the last beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled <= self.threshold or reported == beat:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.thread_id)
+            name, update_id = find_handler(frame)
+            stack = "".join(traceback.format_stack(frame))
+            logging.warning(
+                f"Event loop blocked for {stalled:.3f} s in handler {name}, update_id {update_id}:\n{stack}"
+            )
+
+    def profile(self, duration, path):
+        """
+        Sample the event loop thread stack for `duration` seconds and write
+        the samples in the collapsed format used by flamegraph.pl and speedscope
+        """
+        if not self.profiling.acquire(blocking=False):
+            raise RuntimeError("Profiling is already running")
+        try:
+            stacks = collections.Counter()
+            end = time.monotonic() + duration
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(self.thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+                time.sleep(1 / PROFILE_RATE_HZ)
+            with open(path, "w") as f:
+                for stack, count in stacks.items():
+                    f.write(f"{stack} {count}\n")
+            logging.info(f"Profile written to {path}: {sum(stacks.values())} samples")
+        finally:
+            self.profiling.release()
+
+    async def run_profile(self, duration):
+        path = os.path.join(PROFILE_DIR, f"profile-{int(time.time())}.folded")
+        await asyncio.to_thread(self.profile, duration, path)
+        return path
+
+
+def start(loop, profile_signal_duration=30):
+    """Start monitoring the loop, SIGUSR1 starts a profile of the given duration"""
+    global monitor
+    monitor = LoopMonitor(loop)
+    monitor.start()
+
+    async def profile():
+        try:
+            await monitor.run_profile(profile_signal_duration)
+        except Exception:
+            logging.exception("Error profiling")
+
+    def on_signal():
+        loop.create_task(profile())
+
+    loop.add_signal_handler(signal.SIGUSR1, on_signal)
+    return monitor
@@ -0,0 +1,195 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+# Spans are written as JSON lines to this file, tracing is off if it's unset
+TRACE_FILE = os.environ.get("TRACE_FILE")
+# Share of the updates traced
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+# If set, every update is recorded and the ones slower than this are written too
+TRACE_SLOW_SEC = os.environ.get("TRACE_SLOW_SEC")
+TRACE_SLOW_SEC = None if TRACE_SLOW_SEC is None else float(TRACE_SLOW_SEC)
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace, parent_id, attributes):
+        self.name = name
+        self.trace = trace
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.trace.add(self)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "trace_id": f"{self.trace.trace_id:032x}",
+            "span_id": f"{self.span_id:016x}",
+            "parent_span_id": None if self.parent_id is None else f"{self.parent_id:016x}",
+            "name": self.name,
+            "start_time_unix_nano": self.start,
+            "end_time_unix_nano": self.end,
+            "attributes": self.attributes,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+        }
+
+
+class Trace:
+    def __init__(self, sampled):
+        self.trace_id = random.getrandbits(128)
+        self.sampled = sampled
+        self.spans = []
+        # Whether the trace is written, known once the root span ends
+        self.recorded = None
+
+    def add(self, span):
+        if self.recorded is None:
+            self.spans.append(span)
+            if span.parent_id is None:
+                self.finish(span)
+        elif self.recorded:
+            # The span outlived the root, like a cancelled hedge request
+            write([span])
+
+    def finish(self, root):
+        slow = TRACE_SLOW_SEC is not None and root.end - root.start > TRACE_SLOW_SEC * 1e9
+        self.recorded = self.sampled or slow
+        if self.recorded:
+            write(self.spans)
+        self.spans = []
+
+
+class Writer:
+    """Appends spans to the trace file from a thread, so the event loop doesn't wait for the disk"""
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="trace-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, spans):
+        self.queue.put([span.to_dict() for span in spans])
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while (records := self.queue.get()) is not None:
+            try:
+                with open(self.path, "a") as f:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+            except OSError:
+                logging.exception("Error writing trace")
+
+
+writer = None
+
+
+def write(spans):
+    global writer
+    if writer is None:
+        writer = Writer(TRACE_FILE)
+    writer.write(spans)
+
+
+def close():
+    """Wait for the queued spans to be written"""
+    if writer is not None:
+        writer.close()
+
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def start_trace(name, **attributes):
+    """Root span of a new trace, or a no-op span if the trace isn't recorded"""
+    if TRACE_FILE is None:
+        return NOOP_SPAN
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    if not sampled and TRACE_SLOW_SEC is None:
+        return NOOP_SPAN
+    return Span(name, Trace(sampled), None, attributes)
+
+
+def span(name, **attributes):
+    """Child span of the current span, or a no-op span outside of a trace"""
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(name, parent.trace, parent.span_id, attributes)
+
+
+def traced(name):
+    """Run the coroutine function in a span"""
+
+    def decorator(f):
+        @functools.wraps(f)
+        async def traced_function(*args, **kwargs):
+            with span(name):
+                return await f(*args, **kwargs)
+
+        return traced_function
+
+    return decorator
+
+
+def traced_methods(prefix):
+    """Run every coroutine method of the class in a span named prefix.method"""
+
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if inspect.iscoroutinefunction(value):
+                setattr(cls, attr, traced(f"{prefix}.{attr}")(value))
+        return cls
+
+    return decorator
+
+
+def handler(f):
+    """Trace a telegram handler, each update gets its own trace"""
+
+    @functools.wraps(f)
+    async def traced_handler(update, context):
+        with start_trace(f"bot.{f.__name__}", update_id=update.update_id):
+            return await f(update, context)
+
+    return traced_handler
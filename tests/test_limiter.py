@@ -0,0 +1,80 @@
+import dataclasses
+import random
+
+import pytest
+
+import limiter
+from limiter import Limiter, Priority, SimulatedRequest
+
+LIMITS = {
+    "requests": 10000,
+    "tokens": 2000000,
+    "dalle_3_hd": 15,
+}
+INTERVAL = 60
+INTERACTIVE_P99_BOUND_SEC = 10
+
+
+def make_jobs():
+    """Chats spread over 10 minutes, a burst of HD DALL-E calls and huge prompts"""
+    rng = random.Random(1)
+    jobs = [
+        SimulatedRequest(
+            rng.uniform(0, 600), Priority.INTERACTIVE, {"requests": 1, "tokens": rng.randint(200, 3000)}
+        )
+        for _ in range(600)
+    ]
+    jobs += [
+        SimulatedRequest(100 + i * 0.5, Priority.IMAGE, {"requests": 1, "dalle_3_hd": 1})
+        for i in range(60)
+    ]
+    jobs += [
+        SimulatedRequest(200 + i, Priority.BACKGROUND, {"requests": 1, "tokens": 100000})
+        for i in range(30)
+    ]
+    return jobs
+
+
+def run(weights, jobs):
+    waits, _ = limiter.simulate(Limiter(LIMITS, INTERVAL, weights), jobs)
+    report = {
+        p.name: (limiter.percentile(w, 50), limiter.percentile(w, 99))
+        for (p, w) in waits.items()
+        if w
+    }
+    for name, (p50, p99) in report.items():
+        print(f"{name:12} p50 {p50:8.2f} s, p99 {p99:8.2f} s")
+    return report
+
+
+def test_weighted_fair_queuing_keeps_chats_interactive():
+    report = run(None, make_jobs())
+    assert report["INTERACTIVE"][1] < INTERACTIVE_P99_BOUND_SEC
+
+
+def test_fifo_queues_chats_behind_bulk_work():
+    jobs = [dataclasses.replace(j, priority=Priority.INTERACTIVE) for j in make_jobs()]
+    report = run({Priority.INTERACTIVE: 1}, jobs)
+    assert report["INTERACTIVE"][1] > INTERACTIVE_P99_BOUND_SEC
+
+
+def test_every_job_is_served_once():
+    jobs = make_jobs()
+    waits, end = limiter.simulate(Limiter(LIMITS, INTERVAL), jobs)
+    assert sum(len(w) for w in waits.values()) == len(jobs)
+    assert all(w >= 0 for class_waits in waits.values() for w in class_waits)
+    assert end >= max(j.arrival for j in jobs)
+
+
+def test_settlement_moves_the_following_requests():
+    # 1000 tokens per second
+    limits = {"requests": 10000, "tokens": 60000}
+    jobs = [
+        SimulatedRequest(
+            0, Priority.INTERACTIVE, {"requests": 1, "tokens": 10000}, duration=1, settle={"tokens": 5000}
+        ),
+        SimulatedRequest(2, Priority.INTERACTIVE, {"requests": 1, "tokens": 1000}),
+    ]
+    waits, end = limiter.simulate(Limiter(limits, INTERVAL), jobs)
+    assert waits[Priority.INTERACTIVE] == pytest.approx([0, 13])
+    assert end == pytest.approx(15)